@@ -6,236 +6,50 @@
 A script to remove extra/duplicate precepts from a single or all ideologies.
 """
 
+import hashlib
+import os
 import shutil
 import sys
+import time
 from argparse import ArgumentParser, Namespace
-from collections.abc import Iterable
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
-from typing import Any, TypeVar, overload
+from typing import cast
 
-from elementpath import Selector
-from elementpath.xpath3 import XPath3Parser
-from lxml.etree import XMLParser, fromstring, tostring
+from lxml.etree import XMLParser, XPath, parse
 from lxml.etree import _Element as Element
 from lxml.etree import _ElementTree as ElementTree
 from rich import inspect
 from rich import print as pprint
+from rich.console import Console
 from rich.prompt import Confirm
+from rich.table import Table
 
-HEADER: str = '<?xml version="1.0" encoding="utf-8" ?>'
-T = TypeVar("T")
+ERROR_CONSOLE: Console = Console(stderr=True)
 
+IDEOS_XPATH: XPath = XPath("/savegame/game/world/ideoManager/ideos")
+PRECEPT_LI_XPATH: XPath = XPath("li[not(@Class)]")
 
-def append_many(list_one: list[T], list_two: list[T]) -> list[T]:
-    """Appends many items from one list two another list, and returns the joined list.
 
-    Args:
-        list_one (list[T]): A list of items to append another list to.
-        list_two (list[T]): A list of items to append to the first list.
+def find_child(element: Element, tag: str) -> Element | None:
+    """Finds the first direct child of an element with the given tag.
 
-    Returns:
-        list[T]: The outcome of both lists being appended to eachother.
-    """
-    for item in list_two:
-        list_one.append(item)
-    return list_one
-
-
-class DuplicatePreceptCollection:
-    """A collection of duplicate precepts."""
-
-    names: dict[str, int] = {}
-    def_names: dict[str, int] = {}
-    names_to_defs: dict[str, list[str]] = {}
-    defs_to_names: dict[str, str] = {}
-
-    def items(self) -> Iterable[tuple[str, int]]:
-        """Gets an iterable of each duplicate precepts' names and definition names.
-
-        Returns:
-            Iterable[tuple[str, int]]: The iterable of all duplicate precepts' names and definition
-                names.
-        """
-        names_list: list[tuple[str, int]] = list(self.names.items())
-        def_names_list: list[tuple[str, int]] = list(self.def_names.items())
-        append_many(names_list, def_names_list)
-        return names_list
-
-    @overload
-    def count(self, def_name: str) -> int:  # unused
-        """Returns a count of the amount of a duplicate precept name.
-
-        Args:
-            def_name (str): The definition name of the duplicate precept.
-
-        Returns:
-            int: The count of duplicate precepts with that name.
-        """
-
-    @overload
-    def count(self, name: str) -> int:
-        """Returns a count of the amount of a duplicate precept name.
-
-        Args:
-            name (str): The name of the duplicate precept.
-
-        Returns:
-            int: The count of duplicate precepts with that name.
-        """
-
-    def count(self, **kwargs: str) -> int:  # type: ignore[misc]
-        """Returns a count of the amount of a duplicate precept name.
-
-        Args:
-            name (str): The name of the duplicate precept.
-            def_name (str): The definition name of the duplicate precept.
-
-        Returns:
-            int: The count of duplicate precepts with that name.
-
-        Raises:
-            ValueError: Raised when both or neither of def_name and name are specified.
-            ArithmeticError: Raised when we reach a point that should not have been obtained.
-        """
-
-        def_name: str | None = None
-        if "def_name" in kwargs:
-            def_name = kwargs["def_name"]
-
-        name: str | None = None
-        if "name" in kwargs:
-            name = kwargs["name"]
-
-        if (def_name is None and name is None) or (def_name is not None and name is not None):
-            raise ValueError("One parameter must be specified, def_name or name")
-
-        if name is not None:
-            if name not in self.names:
-                return 1
-            return self.names[name]
-
-        if def_name is not None:
-            if def_name not in self.def_names:
-                return 1
-            return self.def_names[def_name]
-
-        raise ArithmeticError("We should not have gotten here.")
-
-    def append(self, def_name: str, name: str) -> None:
-        """Appends a new duplicate precept & definition name to the collection.
-
-        Args:
-            def_name (str): The duplicate precept definition name.
-            name (str): The duplicate precept name.
-        """
-        if name in self.names:
-            self.names[name] = self.names[name] + 1
-        else:
-            self.names[name] = 1
-        if def_name in self.def_names:
-            self.def_names[def_name] = self.def_names[def_name] + 1
-        else:
-            self.def_names[def_name] = 1
-        if name not in self.names_to_defs:
-            self.names_to_defs[name] = [def_name]
-        if name in self.names_to_defs:
-            self.names_to_defs[name].append(def_name)
-        if def_name not in self.defs_to_names:
-            self.defs_to_names[def_name] = name
-
-    def __remove__(self, def_name: str | None = None, name: str | None = None) -> None:
-        """An internal method to remove a duplicate precept from the name pool.
-
-        Args:
-            def_name (str | None, optional): _description_. Defaults to None.
-            name (str | None, optional): _description_. Defaults to None.
-
-        Raises:
-            ValueError: Raised when both or neither of def_name and name are specified.
-        """
-        if (def_name is None and name is None) or (def_name is not None and name is not None):
-            raise ValueError("One parameter must be specified, def_name or name")
-        if def_name is not None:
-            if def_name in self.def_names and self.def_names[def_name] > 0:
-                self.def_names[def_name] = self.def_names[def_name] - 1
-        if name is not None:
-            if name in self.names and self.names[name] > 0:
-                self.names[name] = self.names[name] - 1
-
-    @overload
-    def remove(self, def_name: str) -> None:
-        """Removes a duplicate precept from the name pool.
-
-        Args:
-            def_name (str): The precept definition name to match to remove from the name pool.
-        """
-
-    @overload
-    def remove(self, name: str) -> None:  # Unused.
-        """Removes a duplicate precept from the name pool.
-
-        Args:
-            name (str): The precept name to match to remove from the name pool.
-        """
-
-    def remove(self, **kwargs: str) -> None:  # type: ignore[misc]
-        """Removes a duplicate precept from the name pool.
-
-        Args:
-            def_name (str): The precept definition name to match to remove from the name pool.
-            name (str): The precept name to match to remove from the name pool.
-
-        Raises:
-            ValueError: Raised when both or neither of def_name and name are specified.
-        """
-
-        def_name: str | None = None
-        if "def_name" in kwargs:
-            def_name = kwargs["def_name"]
-
-        name: str | None = None
-        if "name" in kwargs:
-            name = kwargs["name"]
-
-        if (def_name is None and name is None) or (def_name is not None and name is not None):
-            raise ValueError("One parameter must be specified, def_name or name")
-
-        if def_name is not None:
-            self.__remove__(def_name=def_name)
-            self.__remove__(name=self.defs_to_names[def_name])
-
-        if name is not None:
-            self.__remove__(name=name)
-            for _def_name in self.names_to_defs[name]:
-                self.__remove__(def_name=_def_name)
-
-
-def firstline(text: str) -> str:
-    """Gets the contents of the first line in a multiline string.
+    Unlike Element.find this does not parse an ElementPath expression per call; it is a single
+    C-level iteration over the element's children.
 
     Args:
-        text (str): The text to get the first line contents of.
+        element (Element): The element to search the children of.
+        tag (str): The tag name of the child to find.
 
     Returns:
-        str: The contents of the first line in the text.
+        Element | None: The first matching child element. Or none if not found.
     """
-    return text.splitlines()[0]
-
-
-def insert_firstline(text: str, new_line: str) -> str:
-    """Inserts a new line at the first line in a multiline string
-
-    Args:
-        text (str): The contents of the string to prepend a line to.
-        new_line (str): The contents of the line to prepend to the text.
-
-    Returns:
-        str: The completed text with the new_line appended to the beginning.
-    """
-    is_carriage_return = "\n"
-    if "\r\n" in text:
-        is_carriage_return = "\r\n"
-    return f"{new_line}{is_carriage_return}{text}"
+    for child in element:
+        if child.tag == tag:
+            return child
+    return None
 
 
 def search_xml_tree_for_ideos(root: Element) -> Element | None:
@@ -247,10 +61,8 @@ def search_xml_tree_for_ideos(root: Element) -> Element | None:
     Returns:
         Element | None: The element that contains all the ideologies. Or none if not found.
     """
-    xpath: str = "/savegame/game/world/ideoManager/ideos"
-    selector = Selector(xpath, parser=XPath3Parser)
-    found: list[Element] | None = selector.select(root)
-    if found is not None and len(found) >= 1:
+    found: list[Element] = cast(list[Element], IDEOS_XPATH(root))
+    if len(found) >= 1:
         return found[0]
     return None
 
@@ -264,152 +76,178 @@ def search_xml_tree_for_precepts(root: Element) -> Element | None:
     Returns:
         Element | None: _description_
     """
-    xpath: str = "precepts"
-    selector = Selector(xpath, parser=XPath3Parser)
-    found: list[Element] | None = selector.select(root)
-    if found is not None and len(found) >= 1:
-        return found[0]
-    return None
+    return root.find("precepts")
 
 
 def clean_precepts(
-    duplicate_precepts: DuplicatePreceptCollection,
+    duplicates: list[tuple[Element, str, str]],
     found_precept: Element,
-    found_precepts: list[Element],
     ideo_name: str,
+    assume_yes: bool = False,
 ) -> None:
     """Cleans duplicate precepts
 
     Args:
-        duplicate_precepts (DuplicatePreceptCollection): _description_
+        duplicates (list[tuple[Element, str, str]]): The duplicate precept elements to remove,
+            paired with their name and definition name.
         found_precept (Element): _description_
-        found_precepts (list[Element]): _description_
         ideo_name (str): _description_
+        assume_yes (bool, optional): Skip the confirmation prompt. Defaults to False.
     """
-    for precept_index, precept_element in enumerate(found_precepts):
-        if "Class" in precept_element.attrib.keys():
-            continue
-        precept_name_element: Element | None = precept_element.find("name")
-        if precept_name_element is None:
-            pprint(
-                "[red]Failed to find name element for precept at position"
-                f"{precept_index} in ideo {ideo_name}[/red]"
-            )
-            continue
-        precept_name: str | None = precept_name_element.text
-        if precept_name is None:
-            pprint(
-                "[red]Failed to find name (inner text) for precept at position"
-                f"{precept_index} in ideo {ideo_name}[/red]"
-            )
-            continue
-        precept_def_element: Element | None = precept_element.find("def")
-        if precept_def_element is None:
-            pprint(
-                "[red]Failed to find def name for precept at position"
-                f"{precept_index} in ideo {ideo_name}[/red]"
-            )
-            continue
-        precept_def: str | None = precept_def_element.text
-        if precept_def is None:
-            pprint(
-                "[red]Failed to find def name (inner text) for precept at position"
-                f"{precept_index} in ideo {ideo_name}[/red]"
-            )
-            continue
-        if (
-            precept_name in duplicate_precepts.names
-            and precept_def in duplicate_precepts.def_names
-            and duplicate_precepts.count(name=precept_name) > 1
-        ):
-            if (
-                Confirm.ask(
-                    f"Remove precept {precept_name} with def {precept_def} from ideo {ideo_name}?",
-                    default=True,
-                )
-                is True
-            ):
-                found_precept.remove(precept_element)
-                duplicate_precepts.remove(def_name=precept_def)
-    for key, value in duplicate_precepts.items():
-        if value > 1:
-            pprint(f"Failed to remove extra precept for {key}, we have {value - 1} more")
-
-
-def parse_precepts(found_precept: Element, found_precepts: list[Element], ideo_name: str) -> None:
+    if len(duplicates) == 0:
+        return
+    remaining: Counter[str] = Counter(precept_name for _, precept_name, _ in duplicates)
+    table: Table = Table(title=f"Duplicate precepts in ideo {ideo_name}")
+    table.add_column("Name")
+    table.add_column("Def")
+    for _, precept_name, precept_def in duplicates:
+        table.add_row(precept_name, precept_def)
+    if not assume_yes:
+        pprint(table)
+    if (
+        assume_yes
+        or Confirm.ask(
+            f"Remove all {len(duplicates)} duplicate precepts from ideo {ideo_name}?",
+            default=True,
+        )
+        is True
+    ):
+        for precept_element, precept_name, _ in duplicates:
+            found_precept.remove(precept_element)
+            precept_element.clear()
+            remaining[precept_name] -= 1
+    for precept_name, count in remaining.items():
+        if count > 0:
+            pprint(f"Failed to remove extra precept for {precept_name}, we have {count} more")
+
+
+def parse_precepts(found_precepts: list[Element], ideo_name: str) -> list[tuple[Element, str, str]]:
     """Parses each precept
 
     Args:
-        found_precept (Element): _description_
         found_precepts (list[Element]): _description_
         ideo_name (str): _description_
+
+    Returns:
+        list[tuple[Element, str, str]]: The duplicate precept elements beyond the first occurrence
+            of each name, paired with their name and definition name.
     """
-    precept_cache: list[str] = []
-    duplicate_precepts = DuplicatePreceptCollection()
-    for precept_index, precept_element in enumerate(found_precepts):
-        if "Class" in precept_element.attrib.keys():
-            continue
-        precept_name_element: Element | None = precept_element.find("name")
+    grouped_precepts: defaultdict[str, list[tuple[Element, str, str]]] = defaultdict(list)
+    for precept_element in found_precepts:
+        precept_name_element: Element | None = find_child(precept_element, "name")
         if precept_name_element is None:
-            pprint(
+            ERROR_CONSOLE.print(
                 "[red]Failed to find name element for precept at position"
-                f"{precept_index} in ideo {ideo_name}[/red]"
+                f"{found_precepts.index(precept_element)} in ideo {ideo_name}[/red]"
             )
             continue
         precept_name: str | None = precept_name_element.text
         if precept_name is None:
-            pprint(
+            ERROR_CONSOLE.print(
                 "[red]Failed to find name (inner text) for precept at position"
-                f"{precept_index} in ideo {ideo_name}[/red]"
+                f"{found_precepts.index(precept_element)} in ideo {ideo_name}[/red]"
             )
             continue
-        precept_def_element: Element | None = precept_element.find("def")
+        precept_def_element: Element | None = find_child(precept_element, "def")
         if precept_def_element is None:
-            pprint(
+            ERROR_CONSOLE.print(
                 "[red]Failed to find def element for precept at position"
-                f"{precept_index} in ideo {ideo_name}[/red]"
+                f"{found_precepts.index(precept_element)} in ideo {ideo_name}[/red]"
             )
             continue
         precept_def: str | None = precept_def_element.text
         if precept_def is None:
-            pprint(
+            ERROR_CONSOLE.print(
                 "[red]Failed to find def name (inner text) for precept at position"
-                f"{precept_index} in ideo {ideo_name}[/red]"
+                f"{found_precepts.index(precept_element)} in ideo {ideo_name}[/red]"
             )
             continue
-        if precept_name in precept_cache:
-            duplicate_precepts.append(precept_def, precept_name)
-        precept_cache.append(precept_name)
+        grouped_precepts[precept_name].append((precept_element, precept_name, precept_def))
+
+    duplicates: list[tuple[Element, str, str]] = []
+    for grouped in grouped_precepts.values():
+        if len(grouped) > 1:
+            duplicates.extend(grouped[1:])
+
+    return duplicates
 
-    clean_precepts(duplicate_precepts, found_precept, found_precepts, ideo_name)
 
+def scan_ideo(
+    found_ideos: list[Element], ideo_element: Element
+) -> tuple[Element, str, list[tuple[Element, str, str]]] | None:
+    """Scans a single ideology for duplicate precepts without mutating the tree.
 
-def parse_ideo(found_ideos: list[Element]) -> None:
+    Args:
+        found_ideos (list[Element]): All ideology elements, used to report positions on errors.
+        ideo_element (Element): The ideology element to scan.
+
+    Returns:
+        tuple[Element, str, list[tuple[Element, str, str]]] | None: The precepts parent element,
+            the ideo name and the duplicate precepts found. Or none if the ideo is malformed.
+    """
+    ideo_name_element: Element | None = find_child(ideo_element, "name")
+    if ideo_name_element is None:
+        ERROR_CONSOLE.print(
+            f"[red]Failed to find ideo name for ideo at position "
+            f"{found_ideos.index(ideo_element)}[/red]"
+        )
+        return None
+    ideo_name: str | None = ideo_name_element.text
+    if ideo_name is None:
+        ERROR_CONSOLE.print(
+            "[red]Failed to find ideo name (inner text) for ideo at position"
+            f"{found_ideos.index(ideo_element)}[/red]"
+        )
+        return None
+    found_precept: Element | None = search_xml_tree_for_precepts(ideo_element)
+    if found_precept is None:
+        ERROR_CONSOLE.print(f"[red]No precepts node found in ideo {ideo_name}[/red]")
+        return None
+    found_precepts: list[Element] = cast(list[Element], PRECEPT_LI_XPATH(found_precept))
+    if len(found_precepts) == 0:
+        ERROR_CONSOLE.print(f"[red]No precepts found in ideo {ideo_name}[/red]")
+        return None
+    return (found_precept, ideo_name, parse_precepts(found_precepts, ideo_name))
+
+
+def parse_ideo(found_ideos: list[Element], assume_yes: bool = False) -> None:
     """Parses each ideology
 
+    Each ideology's scan only reads its own subtree, and lxml releases the GIL across libxml2
+    calls, so with --yes the scans run in a thread pool. Removals are applied on the main thread
+    afterwards so the tree is never mutated from multiple threads.
+
     Args:
         found_ideos (list[Element]): _description_
+        assume_yes (bool, optional): Skip the confirmation prompt. Defaults to False.
     """
-    for ideo_index, ideo_element in enumerate(found_ideos):
-        ideo_name_element: Element | None = ideo_element.find("name")
-        if ideo_name_element is None:
-            pprint(f"[red]Failed to find ideo name for ideo at position {ideo_index}[/red]")
-            continue
-        ideo_name: str | None = ideo_name_element.text
-        if ideo_name is None:
-            pprint(
-                f"[red]Failed to find ideo name (inner text) for ideo at position{ideo_index}[/red]"
-            )
-            continue
-        found_precept: Element | None = search_xml_tree_for_precepts(ideo_element)
-        if found_precept is None:
-            pprint(f"[red]No precepts node found in ideo {ideo_name}[/red]")
+    scanned: list[tuple[Element, str, list[tuple[Element, str, str]]] | None]
+    if assume_yes:
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            scanned = list(executor.map(partial(scan_ideo, found_ideos), found_ideos))
+    else:
+        scanned = [scan_ideo(found_ideos, ideo_element) for ideo_element in found_ideos]
+    for scan in scanned:
+        if scan is None:
             continue
-        found_precepts: list[Element] | None = found_precept.findall("li")
-        if found_precepts is None:
-            pprint(f"[red]No precepts found in ideo {ideo_name}[/red]")
-            continue
-        parse_precepts(found_precept, found_precepts, ideo_name)
+        found_precept, ideo_name, duplicates = scan
+        clean_precepts(duplicates, found_precept, ideo_name, assume_yes)
+
+
+def hash_file(file_path: Path) -> bytes:
+    """Hashes a file's contents in fixed-size chunks without loading the whole file.
+
+    Args:
+        file_path (Path): The path to the file to hash.
+
+    Returns:
+        bytes: The BLAKE2 digest of the file's contents.
+    """
+    file_hash = hashlib.blake2b(digest_size=16)
+    with file_path.open("rb") as file_read:
+        while chunk := file_read.read(16 * 1024 * 1024):
+            file_hash.update(chunk)
+    return file_hash.digest()
 
 
 def backup_save_file(file_path: Path) -> None:
@@ -418,10 +256,11 @@ def backup_save_file(file_path: Path) -> None:
     Args:
         file_path (Path): The path to the file to backup.
     """
-    backup_file = f"{file_path}.bak"
-    last_index = 1
+    timestamp: str = time.strftime("%Y%m%dT%H%M%S")
+    backup_file: str = f"{file_path}.{timestamp}.bak"
+    last_index: int = 1
     while Path(backup_file).exists():
-        backup_file = f"{backup_file}.{last_index}"
+        backup_file = f"{file_path}.{timestamp}.{last_index}.bak"
         last_index = last_index + 1
     shutil.move(file_path, backup_file)
 
@@ -438,6 +277,12 @@ def main() -> None:
         epilog="Created by Neko Boi Nick.",
     )
     parser.add_argument("file", help="A path to a save file to modify.")
+    parser.add_argument(
+        "--yes",
+        "-y",
+        action="store_true",
+        help="Remove duplicate precepts without asking for confirmation.",
+    )
     parsed: Namespace = parser.parse_args()
 
     file_path = Path(parsed.file)
@@ -445,13 +290,10 @@ def main() -> None:
     if not file_path.exists():
         raise FileNotFoundError(f"File not found at path {file_path}")
 
-    file_contents: bytes | None = None
-    xml_parser = XMLParser(encoding="utf8", huge_tree=True)
-
-    with file_path.open("rb") as file_read:
-        file_contents = file_read.read()
+    xml_parser: XMLParser = XMLParser(encoding="utf8", huge_tree=True)
 
-    root: ElementTree | Any = fromstring(file_contents, xml_parser)
+    tree: ElementTree = parse(str(file_path), xml_parser)
+    root: Element | None = tree.getroot()
 
     if root is None:
         pprint("[red]Failed to parse xml file[/red]")
@@ -474,27 +316,18 @@ def main() -> None:
         pprint("[red]No ideos found on provided save file[/red]")
         sys.exit(1)
 
-    parse_ideo(found_ideos)
-    backup_save_file(file_path)
-
-    if not isinstance(root, Element):
-        pprint("[red]Root element is not an instance of Element")
-        sys.exit(1)
-
-    new_file_contents: bytes | str = tostring(root, encoding="utf8")
+    parse_ideo(found_ideos, parsed.yes)
 
-    if isinstance(new_file_contents, bytes):
-        new_file_contents = new_file_contents.decode()
+    temp_file: Path = file_path.with_name(f"{file_path.name}.tmp")
+    tree.write(str(temp_file), encoding="utf-8", xml_declaration=True)
 
-    if not firstline(new_file_contents).startswith(HEADER):
-        insert_firstline(new_file_contents, HEADER)
-
-    if new_file_contents == file_contents:
+    if hash_file(temp_file) == hash_file(file_path):
+        temp_file.unlink()
         pprint("[yellow]:warning: No Changes![/yellow]")
         sys.exit(0)
 
-    with file_path.open("w", encoding="utf8") as file_write:
-        file_write.write(new_file_contents)
+    backup_save_file(file_path)
+    os.replace(temp_file, file_path)
 
     pprint("[green]Done![/green]")
     sys.exit(0)